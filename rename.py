@@ -1,24 +1,225 @@
 import os
-import shutil
+import re
+import json
 import argparse
+from datetime import datetime
 
 
-def rename_files_in_directory(directory):
-    for root, _, files in os.walk(directory):
-        # Extract the name of the current directory
-        dir_name = os.path.basename(root)
-        for file in files:
-            file_path = os.path.join(root, file)
-            new_file_name = f"{dir_name}.{file}"
-            new_file_path = os.path.join(root, new_file_name)
-            shutil.move(file_path, new_file_path)
-            print(f"Renamed {file} to {new_file_name}")
+YEAR_DIRECTORY = re.compile(r'^.*(200[2-9]|20[1-9][0-9])$', re.DOTALL)
+
+
+def scan_tree(directory):
+    """list the files and sub directories of every directory under the given one, with a single scandir per directory
+    return: dict like {directory: (file_names, directory_names)}
+    """
+    tree = {}
+    pending = [os.path.normpath(directory)]
+    while pending:
+        current = pending.pop()
+        files = []
+        dirs = []
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                    pending.append(entry.path)
+                else:
+                    files.append(entry.name)
+        tree[current] = (files, dirs)
+    return tree
+
+
+def unique_name(name, taken):
+    if name not in taken:
+        return name
+    (stem, ext) = os.path.splitext(name)
+    counter = 1
+    while f"{stem} ({counter}){ext}" in taken:
+        counter += 1
+    return f"{stem} ({counter}){ext}"
+
+
+def plan_file_renames(tree):
+    """prepend the directory name to every file name
+    return: tuple like (operations, collisions)
+    """
+    operations = []
+    collisions = []
+    for (directory, (files, dirs)) in tree.items():
+        prefix = os.path.basename(directory)
+        taken = set(dirs)
+        renames = []
+        for name in files:
+            new_name = f"{prefix}.{name}"
+            if new_name in taken:
+                collisions.append(os.path.join(directory, new_name))
+                new_name = unique_name(new_name, taken)
+            taken.add(new_name)
+            renames.append((name, new_name))
+
+        # 'x.jpg' becomes 'd.x.jpg' while an existing 'd.x.jpg' becomes
+        # 'd.d.x.jpg': longer names move first so nothing gets overwritten
+        renames.sort(key=lambda rename: len(rename[0]), reverse=True)
+        operations += [('rename', os.path.join(directory, name), os.path.join(directory, new_name))
+                       for (name, new_name) in renames]
+    return operations, collisions
+
+
+def plan_year_renames(tree):
+    """rename directories ending with a year to just the year, merging directories which end up with the same name
+    return: tuple like (operations, collisions)
+    """
+    operations = []
+    collisions = []
+    for (parent, (files, dirs)) in tree.items():
+        targets = {}
+        for name in sorted(dirs):
+            match = YEAR_DIRECTORY.match(name)
+            target = match.group(1) if match else name
+            targets.setdefault(target, []).append(name)
+
+        taken = set(files)
+        for (target, names) in targets.items():
+            if target in taken:
+                collisions.append(os.path.join(parent, target))
+                target = unique_name(target, taken)
+            taken.add(target)
+
+            if target in names:
+                # A directory already has the final name, the others merge into it
+                destination = target
+            else:
+                destination = names[0]
+                operations.append(('rename', os.path.join(parent, destination),
+                                   os.path.join(parent, target)))
+            for name in names:
+                if name != destination:
+                    collisions.append(os.path.join(parent, name))
+                    operations.append(('merge', os.path.join(parent, name),
+                                       os.path.join(parent, target)))
+
+    # Bottom-up: children are renamed while their parents still have the
+    # scanned paths, and within a directory renames come before the merges
+    operations.sort(key=lambda operation: (-operation[1].count(os.sep), operation[0] == 'merge'))
+    return operations, collisions
+
+
+class UndoLog:
+    def __init__(self, path):
+        # 'x': appending to an older log would make undo replay both runs
+        self.file = open(path, 'x', encoding='utf8')
+
+    def record(self, operation, *paths):
+        self.file.write(json.dumps([operation, *paths]) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def merge_directories(source, destination, log):
+    with os.scandir(source) as entries:
+        names = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries]
+    taken = set(os.listdir(destination))
+    for (name, is_dir) in names:
+        target = os.path.join(destination, name)
+        if name in taken and is_dir and os.path.isdir(target):
+            merge_directories(os.path.join(source, name), target, log)
+            continue
+        new_name = unique_name(name, taken)
+        taken.add(new_name)
+        os.rename(os.path.join(source, name), os.path.join(destination, new_name))
+        log.record('rename', os.path.join(source, name), os.path.join(destination, new_name))
+    os.rmdir(source)
+    log.record('rmdir', source)
+
+
+def apply_plan(operations, log, batch_size):
+    for start in range(0, len(operations), batch_size):
+        for (operation, source, destination) in operations[start:start + batch_size]:
+            if operation == 'merge':
+                merge_directories(source, destination, log)
+            else:
+                os.rename(source, destination)
+                log.record('rename', source, destination)
+        # The log is on disk before the next batch starts, so an
+        # interrupted run can still be undone
+        log.flush()
+        done = min(start + batch_size, len(operations))
+        print(f"Applied {done}/{len(operations)} operations")
+
+
+def undo(log_path):
+    with open(log_path, encoding='utf8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for record in reversed(records):
+        if record[0] == 'rmdir':
+            os.mkdir(record[1])
+        else:
+            os.rename(record[2], record[1])
+    print(f"Reverted {len(records)} operations from {log_path}")
+
+
+def print_plan(operations, collisions):
+    for (operation, source, destination) in operations:
+        print(f"{operation}: {source!r} -> {destination!r}")
+    for path in collisions:
+        print(f"collision: {path!r}")
+    print(f"{len(operations)} operation(s), {len(collisions)} collision(s)")
+
+
+def rename_directory(directory, mode, dry_run, undo_log, batch_size):
+    # Absolute paths, so the undo log works from any working directory
+    tree = scan_tree(os.path.abspath(directory))
+    if mode == 'files':
+        (operations, collisions) = plan_file_renames(tree)
+    else:
+        (operations, collisions) = plan_year_renames(tree)
+
+    if dry_run:
+        print_plan(operations, collisions)
+        return
+
+    print(f"{len(operations)} operation(s), {len(collisions)} collision(s)")
+    try:
+        log = UndoLog(undo_log)
+    except FileExistsError:
+        print(f"Undo log {undo_log} already exists, choose another --undo_log")
+        return
+    try:
+        apply_plan(operations, log, batch_size)
+    finally:
+        log.close()
+    print(f"Undo log written to {undo_log}")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Rename all files by prepending the directory name to the filename.')
-    parser.add_argument('directory', type=str,
-                        help='The directory containing the files to rename')
+        description='Bulk rename a Takeout tree: plan every rename first, then apply it bottom-up with an undo log.')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    default_log = f"rename-undo-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl"
+    for (mode, description) in [('files', 'Prepend the directory name to every file name'),
+                                ('years', 'Rename directories ending with a year (2002-2099) to just the year, merging collisions')]:
+        subparser = subparsers.add_parser(mode, help=description)
+        subparser.add_argument('directory', type=str,
+                               help='The directory containing the entries to rename')
+        subparser.add_argument('-n', '--dry_run', action='store_true',
+                               help='Print the plan without renaming anything')
+        subparser.add_argument('--undo_log', default=default_log,
+                               help='Where to write the undo log (default: ./rename-undo-<time>.jsonl)')
+        subparser.add_argument('--batch_size', type=int, default=10000,
+                               help='Number of renames between undo log syncs (default: 10000)')
+
+    undo_parser = subparsers.add_parser('undo', help='Revert a previous run from its undo log')
+    undo_parser.add_argument('undo_log', type=str)
+
     args = parser.parse_args()
-    rename_files_in_directory(args.directory)
+    if args.mode == 'undo':
+        undo(args.undo_log)
+    else:
+        rename_directory(args.directory, args.mode, args.dry_run,
+                         args.undo_log, args.batch_size)
@@ -1,15 +1,14 @@
 import os
-import time
-from datetime import datetime
 import piexif
 from fractions import Fraction
 
 
 # Credit: https://stackoverflow.com/questions/3173320/text-progress-bar-in-terminal-with-block-characters
-def progressBar(iterable, prefix='', suffix='', decimals=1, length=100, fill='█', printEnd="\r", upLines=0):
+def progressBar(iterable, prefix='', suffix='', decimals=1, length=100, fill='█', printEnd="\r", upLines=0, total=None):
     UP = "\x1B[" + str(upLines + 1) + "A"
 
-    total = len(iterable)
+    if total is None:
+        total = len(iterable)
     # Progress Bar Printing Function
 
     def printProgressBar(iteration):
@@ -30,46 +29,6 @@ def progressBar(iterable, prefix='', suffix='', decimals=1, length=100, fill='
     print()
 
 
-# Function to search media associated to the JSON
-def searchMedia(path, title, editedWord):
-    try:
-        title = fixTitle(title)
-        (file_name, ext) = os.path.splitext(title)
-        possible_titles = [
-            title,
-            str(file_name + "-" + editedWord + "." + ext),
-            str(file_name + "(1)." + ext),
-        ]
-
-        # Check for exact matches first
-        for title in possible_titles:
-            filepath = os.path.join(path, title)
-            if os.path.exists(filepath):
-                return filepath
-
-        # If no exact match is found, search for "looser" matches
-        # for entry in os.listdir(path):
-        #     # Check if the entry is a video file and matches the first 90% of the title
-        #     abbrev_title = title[:int(len(title)*0.9)]
-        #     print(f"TRYING WITH ABBREVIATED TITLE: {abbrev_title}")
-        #     if entry.endswith((".mp4", ".mov")) and entry.startswith(title[:int(len(title)*0.9)]):
-        #         return os.path.join(path, entry)
-
-        # If no matching file is found, return None
-        return None
-
-    except Exception as e:
-        print(f"Error in searchMedia: {e}")
-        return None
-
-
-# Supress incompatible characters
-def fixTitle(title):
-    return str(title).replace("%", "").replace("<", "").replace(">", "").replace("=", "").replace(":", "").replace("?", "").replace(
-        "¿", "").replace("*", "").replace("#", "").replace("&", "").replace("{", "").replace("}", "").replace("\\", "").replace(
-        "@", "").replace("!", "").replace("¿", "").replace("+", "").replace("|", "").replace("\"", "").replace("\'", "")
-
-
 # Recursive function to search name if its repeated
 def checkIfSameName(title, titleFixed, matchedFiles, recursionTime):
     if titleFixed in matchedFiles:
@@ -80,12 +39,6 @@ def checkIfSameName(title, titleFixed, matchedFiles, recursionTime):
         return titleFixed
 
 
-def setFileCreationTime(filepath, timeStamp):
-    date = datetime.fromtimestamp(timeStamp)
-    modTime = time.mktime(date.timetuple())
-    os.utime(filepath, (modTime, modTime))
-
-
 def to_deg(value, loc):
     """convert decimal coordinates into degrees, munutes and seconds tuple
     Keyword arguments: value is float gps-value, loc is direction list ["S", "N"] or ["W", "E"]
@@ -138,17 +91,14 @@ def set_geo_exif(exif_dict, lat, lng, altitude):
     exif_dict['GPS'] = gps_ifd
 
 
-def set_date_exif(exif_dict, timestamp):
-    dateTime = datetime.fromtimestamp(timestamp).strftime("%Y:%m:%d %H:%M:%S")
+def set_date_exif(exif_dict, dateTime):
     exif_dict['0th'][piexif.ImageIFD.DateTime] = dateTime
     exif_dict["0th"][piexif.ImageIFD.Orientation] = 1
     exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = dateTime
     exif_dict['Exif'][piexif.ExifIFD.DateTimeDigitized] = dateTime
 
 
-def adjust_exif(exif_info, metadata):
-    timeStamp = int(metadata['photoTakenTime']['timestamp'])
-
+def adjust_exif(exif_info, dateTime):
     exif_dict = piexif.load(exif_info)
 
     # del exif_dict["thumbnail"]
@@ -157,7 +107,7 @@ def adjust_exif(exif_info, metadata):
     # lng = metadata['geoData']['longitude']
     # altitude = metadata['geoData']['altitude']
 
-    set_date_exif(exif_dict, timeStamp)
+    set_date_exif(exif_dict, dateTime)
     # set_geo_exif(exif_dict, lat, lng, altitude)
 
     try:
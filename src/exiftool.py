@@ -0,0 +1,110 @@
+import subprocess
+import threading
+
+
+READY = '{ready}'
+
+
+class ExifTool:
+    """a single exiftool process kept open with -stay_open, fed through its argument file on stdin"""
+
+    def __init__(self, path):
+        self.process = subprocess.Popen(
+            [path, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            encoding='utf8')
+
+    def execute(self, args):
+        self.process.stdin.write('\n'.join(args) + '\n-execute\n')
+        self.process.stdin.flush()
+
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise OSError("exiftool exited unexpectedly")
+            if line.rstrip('\n') == READY:
+                break
+            lines.append(line)
+
+        output = ''.join(lines)
+        if any(line.startswith('Error') for line in lines):
+            raise subprocess.CalledProcessError(1, args, output)
+        return output
+
+    def close(self):
+        try:
+            self.process.stdin.write('-stay_open\nFalse\n')
+            self.process.stdin.flush()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class ExifToolPool:
+    """exiftool processes shared between threads, started on demand and kept warm until close()"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tools = []
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def execute(self, args):
+        with self.lock:
+            tool = self.idle.pop() if self.idle else None
+        if tool is None:
+            tool = ExifTool(self.path)
+            with self.lock:
+                self.tools.append(tool)
+
+        try:
+            output = tool.execute(args)
+        except subprocess.CalledProcessError:
+            self.release(tool)
+            raise
+        except Exception:
+            # The process is in an unknown state, don't hand it out again
+            with self.lock:
+                self.tools.remove(tool)
+            tool.close()
+            raise
+        self.release(tool)
+        return output
+
+    def release(self, tool):
+        with self.lock:
+            self.idle.append(tool)
+
+    def close(self):
+        """close every worker, including the ones still running a command"""
+        with self.lock:
+            tools = self.tools
+            self.tools = []
+            self.idle = []
+        for tool in tools:
+            tool.close()
+
+
+pool = None
+
+
+def start_workers(path):
+    global pool
+    pool = ExifToolPool(path)
+
+
+def stop_workers():
+    global pool
+    if pool:
+        pool.close()
+    pool = None
+
+
+def run_exiftool(command):
+    """run an exiftool command line, on a warm worker when start_workers() was called"""
+    # The argument file is line based and trims whitespace, so those
+    # arguments still need their own process
+    if pool is None or any('\n' in arg or arg != arg.strip() for arg in command[1:]):
+        return subprocess.run(command, check=True)
+    return pool.execute(command[1:])
@@ -0,0 +1,277 @@
+import os
+import re
+import bisect
+import unicodedata
+
+
+# Characters Google strips from titles when it names files in the export
+TITLE_TRANSLATION = str.maketrans('', '', '%<>=:?¿*#&{}\\@!+|"\'')
+
+# Suffix Google adds to edited copies, per export language
+EDITED_WORDS = {
+    'ca': 'editat',
+    'de': 'bearbeitet',
+    'en': 'edited',
+    'es': 'editado',
+    'fr': 'modifié',
+    'it': 'modificato',
+    'ja': '編集済み',
+    'nl': 'bewerkt',
+    'pl': 'edytowane',
+    'pt': 'editado',
+}
+
+# Takeout cuts sidecar names so that "<name>.json" stays within 51 characters,
+# depending on the export that leaves 46 or 47 characters of the media name
+TRUNCATED_LENGTHS = (46, 47)
+SUPPLEMENTAL = '.supplemental-metadata'
+BRACKET = re.compile(r'^(.*)\((\d+)\)$')
+
+MATCH_EXACT = 1.0
+MATCH_EDITED = 0.9
+MATCH_TRUNCATED = 0.8
+MATCH_OTHER_EXTENSION = 0.6
+MATCH_DUPLICATE = 0.5
+
+
+def fixTitle(title):
+    """supress incompatible characters in a single pass"""
+    return str(title).translate(TITLE_TRANSLATION)
+
+
+def name_key(name):
+    # NFC because macOS hands out decomposed names, casefold because the
+    # sidecar and the media often disagree on the extension case
+    return unicodedata.normalize('NFC', name).casefold()
+
+
+def split_bracket(name):
+    """split Takeout's duplicate counter off a name
+    return: tuple like ('name.jpg', '(1)') or ('name.jpg', '')
+    """
+    match = BRACKET.match(name)
+    if match:
+        return (match.group(1), '(' + match.group(2) + ')')
+    return (name, '')
+
+
+def strip_supplemental(base):
+    """remove a (possibly truncated) '.supplemental-metadata' suffix from a sidecar base name"""
+    index = base.rfind('.')
+    while index > 0:
+        suffix = base[index:]
+        if len(suffix) > 1 and SUPPLEMENTAL.startswith(suffix) and '.' in base[:index]:
+            return base[:index]
+        index = base.rfind('.', 0, index)
+    return base
+
+
+def sidecar_core(json_name):
+    """return the media part of a sidecar name as (core, bracket)
+    'name.jpg(1).json' and 'name.jpg.supplemental-metadata(1).json' both give ('name.jpg', '(1)')
+    """
+    base = json_name[:-len('.json')]
+    (body, bracket) = split_bracket(base)
+    return (strip_supplemental(body), bracket)
+
+
+def truncations(name):
+    return [name[:length] for length in TRUNCATED_LENGTHS if len(name) > length]
+
+
+def assign_media(matches):
+    """keep every media file with the sidecar that matched it with the highest confidence
+    Keyword arguments: matches is a list of (json_path, media_path, confidence) tuples of one folder
+    return: the same list, the other sidecars of an already matched media get (json_path, None, 0.0)
+    """
+    best = {}
+    for (position, (_, media, confidence)) in enumerate(matches):
+        if media is not None and (media not in best or confidence > matches[best[media]][2]):
+            best[media] = position
+    return [(json_path, media, confidence)
+            if media is None or best[media] == position else (json_path, None, 0.0)
+            for (position, (json_path, media, confidence)) in enumerate(matches)]
+
+
+class FolderIndex:
+    def __init__(self):
+        self.media = {}
+        self.sidecars = {}
+        self.sidecar_stems = {}
+        self._sorted_media = None
+
+    @staticmethod
+    def sidecar_keys(name):
+        # Sidecars keep characters the media names lost, so index both spellings
+        (core, bracket) = sidecar_core(name)
+        keys = []
+        for title in dict.fromkeys([core, fixTitle(core)]):
+            (stem, _) = os.path.splitext(title)
+            keys.append((name_key(title + bracket), name_key(stem + bracket)))
+        return keys
+
+    def add(self, name):
+        (_, ext) = os.path.splitext(name)
+        if ext.casefold() == '.json':
+            for (key, stem_key) in self.sidecar_keys(name):
+                self.sidecars.setdefault(key, name)
+                self.sidecar_stems.setdefault(stem_key, set()).add(name)
+        else:
+            self.media[name_key(name)] = name
+            self._sorted_media = None
+
+    def discard(self, name):
+        (_, ext) = os.path.splitext(name)
+        if ext.casefold() == '.json':
+            for (key, stem_key) in self.sidecar_keys(name):
+                if self.sidecars.get(key) == name:
+                    del self.sidecars[key]
+                self.sidecar_stems.get(stem_key, set()).discard(name)
+        else:
+            self.media.pop(name_key(name), None)
+            self._sorted_media = None
+
+    def media_with_prefix(self, prefix):
+        if self._sorted_media is None:
+            self._sorted_media = sorted(self.media)
+        key = name_key(prefix)
+        names = []
+        index = bisect.bisect_left(self._sorted_media, key)
+        while index < len(self._sorted_media) and self._sorted_media[index].startswith(key):
+            names.append(self.media[self._sorted_media[index]])
+            index += 1
+        return names
+
+
+class DirectoryIndex:
+    """file names of every scanned folder, so matching never touches the disk"""
+
+    def __init__(self):
+        self.folders = {}
+
+    def folder(self, folder):
+        return self.folders.setdefault(os.path.normpath(folder), FolderIndex())
+
+    def add_folder(self, folder, names):
+        index = self.folder(folder)
+        for name in names:
+            index.add(name)
+        return index
+
+    def replace_folder(self, folder, names):
+        self.folders[os.path.normpath(folder)] = FolderIndex()
+        return self.add_folder(folder, names)
+
+    def add(self, path):
+        self.folder(os.path.dirname(path)).add(os.path.basename(path))
+
+    def discard(self, path):
+        index = self.folders.get(os.path.normpath(os.path.dirname(path)))
+        if index:
+            index.discard(os.path.basename(path))
+
+
+class MediaMatcher:
+    """pairs Takeout sidecars and media files through a DirectoryIndex
+    Every match comes with a confidence between 0 and 1, see the MATCH_* constants.
+    """
+
+    def __init__(self, index=None, edited_words=None):
+        self.index = index or DirectoryIndex()
+        words = set(EDITED_WORDS.values())
+        if edited_words:
+            words.update(edited_words)
+        self.edited_words = sorted(words, key=len, reverse=True)
+
+    def edited_variants(self, stem):
+        return [stem + '-' + word for word in self.edited_words]
+
+    def without_edited(self, stem):
+        # Compare and slice the same NFC string, a decomposed 'é' is two characters
+        stem = unicodedata.normalize('NFC', stem)
+        for word in self.edited_words:
+            suffix = unicodedata.normalize('NFC', '-' + word)
+            if len(stem) > len(suffix) and name_key(stem[-len(suffix):]) == name_key(suffix):
+                return stem[:-len(suffix)]
+        return None
+
+    def unique_media(self, index, prefix, bracket):
+        names = index.media_with_prefix(prefix)
+        if bracket:
+            names = [name for name in names if bracket in name]
+        if len(names) > 1:
+            names = [name for name in names
+                     if self.without_edited(os.path.splitext(name)[0]) is None]
+        return names[0] if len(names) == 1 else None
+
+    def match_media(self, json_path):
+        """find the media file described by a sidecar
+        return: tuple like (media_path, confidence), media_path is None when nothing matches
+        """
+        folder = os.path.dirname(json_path)
+        index = self.index.folder(folder)
+        json_name = os.path.basename(json_path)
+        (core, bracket) = sidecar_core(json_name)
+
+        for title in dict.fromkeys([core, fixTitle(core)]):
+            (stem, ext) = os.path.splitext(title)
+            candidates = [(stem + bracket + ext, MATCH_EXACT)]
+            candidates += [(edited + bracket + ext, MATCH_EDITED)
+                           for edited in self.edited_variants(stem)]
+            if not bracket:
+                candidates.append((stem + '(1)' + ext, MATCH_DUPLICATE))
+
+            for (candidate, confidence) in candidates:
+                name = index.media.get(name_key(candidate))
+                if name:
+                    return (os.path.join(folder, name), confidence)
+
+            # Cut short by Takeout: the sidecar name is a prefix of the media name
+            if len(json_name) - len('.json') >= min(TRUNCATED_LENGTHS):
+                name = self.unique_media(index, title, bracket)
+                if name:
+                    return (os.path.join(folder, name), MATCH_TRUNCATED)
+
+            # Sidecar without the media extension, or media converted to another one
+            name = self.unique_media(index, stem + '.', bracket)
+            if name:
+                return (os.path.join(folder, name), MATCH_OTHER_EXTENSION)
+
+        return (None, 0.0)
+
+    def match_sidecar(self, media_path):
+        """find the sidecar of a media file
+        return: tuple like (json_path, confidence), json_path is None when nothing matches
+        """
+        folder = os.path.dirname(media_path)
+        index = self.index.folder(folder)
+        (stem, ext) = os.path.splitext(os.path.basename(media_path))
+        (plain_stem, bracket) = split_bracket(stem)
+
+        # 'name(1).jpg' belongs to 'name.jpg(1).json'
+        candidates = [(stem + ext, '', MATCH_EXACT),
+                      (plain_stem + ext, bracket, MATCH_EXACT)]
+        original = self.without_edited(plain_stem)
+        if original is not None:
+            candidates.append((original + ext, bracket, MATCH_EDITED))
+
+        for (name, name_bracket, confidence) in candidates:
+            json_name = index.sidecars.get(name_key(name + name_bracket))
+            if json_name:
+                return (os.path.join(folder, json_name), confidence)
+
+        for (name, name_bracket, _) in candidates:
+            for truncated in truncations(name):
+                json_name = index.sidecars.get(name_key(truncated + name_bracket))
+                if json_name:
+                    return (os.path.join(folder, json_name), MATCH_TRUNCATED)
+
+        # Converted media keeps its stem but not its extension ('IMG_1.HEIC' -> 'IMG_1.jpg.json')
+        for stem_candidate in dict.fromkeys([plain_stem, original]):
+            if stem_candidate is None:
+                continue
+            json_names = index.sidecar_stems.get(name_key(stem_candidate + bracket))
+            if json_names and len(json_names) == 1:
+                return (os.path.join(folder, next(iter(json_names))), MATCH_OTHER_EXTENSION)
+
+        return (None, 0.0)
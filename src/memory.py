@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from PIL import Image
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Decoded bytes per pixel of the Pillow modes found in photos
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3,
+              'LAB': 3, 'HSV': 3, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4, 'I': 4, 'F': 4}
+
+# convert('RGB') and the orientation fix each hold another RGB copy
+# next to the decoded source
+RGB_COPIES = 2
+
+
+def estimate_decode_cost(path):
+    """estimate the memory an image needs while being processed, from its header only
+    return: size in bytes, 0 when the file can't be read as an image
+    """
+    try:
+        with Image.open(path) as image:
+            (width, height) = image.size
+            source_bytes = MODE_BYTES.get(image.mode, 4)
+    except Exception:
+        return 0
+    return width * height * (source_bytes + 3 * RGB_COPIES)
+
+
+class MemoryBudget:
+    """admit jobs only while their estimated memory stays under the limit
+    A job bigger than the whole limit is still admitted, but only on its own.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, cost):
+        with self.condition:
+            while self.used > 0 and self.used + cost > self.limit:
+                self.condition.wait()
+            self.used += cost
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= cost
+                self.condition.notify_all()
+
+
+def current_rss():
+    """resident memory of the process in bytes, the peak so far where the current value isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageMemory:
+    """highest process RSS observed at the end of each processing stage
+    Every sample covers the whole process, so with several workers it includes
+    whatever the other workers hold at that moment.
+    """
+
+    def __init__(self):
+        self.peaks = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage):
+        rss = current_rss()
+        with self.lock:
+            if rss > self.peaks.get(stage, 0):
+                self.peaks[stage] = rss
+
+    def report(self):
+        print("Peak process RSS sampled after each stage (all workers included):")
+        for (stage, peak) in self.peaks.items():
+            print(f"  {stage}: {peak / (1024 * 1024):.1f} MB")
@@ -1,5 +1,6 @@
 import os
 from process_folder import processFolder
+from scheduler import ORDERS
 import argparse
 
 
@@ -11,6 +12,32 @@ def dimension(s):
         raise argparse.ArgumentTypeError("Dimension must be width,height")
 
 
+def memory_size(s):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    try:
+        s = s.strip().upper().rstrip('B')
+        if s[-1:] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except:
+        raise argparse.ArgumentTypeError("Memory size must be bytes or a size like 512M, 4G")
+
+
+def renditions(s):
+    try:
+        result = []
+        for rendition in s.split(','):
+            name, quality = rendition.strip().split(':')
+            if not quality.startswith('q'):
+                raise ValueError(quality)
+            max_dimension = None if name == 'full' else (int(name), int(name))
+            result.append((name, max_dimension, int(quality[1:])))
+        return result
+    except:
+        raise argparse.ArgumentTypeError(
+            "Renditions must be size:qQUALITY pairs, like full:q90,2048:q80,400:q70")
+
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('source_folder')
@@ -21,6 +48,26 @@ parser.add_argument('-o',  '--optimize', type=int, default=100,
                     help='Optimalize the images (0 to 100), recommended: 75 (default: disabled)')
 parser.add_argument('-m',  '--max_dimension', type=dimension,
                     help="Resize the image restricting the max width,height dimension")
+parser.add_argument('-j',  '--jobs', type=int,
+                    help="Number of images processed in parallel (default: CPU count)")
+parser.add_argument('-v',  '--video_jobs', type=int, default=1,
+                    help="Number of videos remuxed in parallel (default: 1)")
+parser.add_argument('--order', choices=ORDERS, default='size',
+                    help="Processing order: largest files first, or directory/inode order for HDD and network shares (default: size)")
+parser.add_argument('--readahead', type=int, default=8,
+                    help="Number of upcoming files to prefetch while processing, 0 disables it (default: 8)")
+parser.add_argument('--drop_cache', action='store_true',
+                    help="Drop written outputs from the page cache once they reach the disk, for runs larger than the host's memory")
+parser.add_argument('-r',  '--renditions', type=renditions,
+                    help="Write several sizes from a single decode, each into its own subfolder, like full:q90,2048:q80,400:q70 (overrides --optimize and --max_dimension)")
+parser.add_argument('-M',  '--max_memory', '--max-memory', type=memory_size,
+                    help="Memory budget for decoding images in parallel, like 4G; oversized images are processed one at a time (default: unlimited)")
+parser.add_argument('-W',  '--watch', action='store_true',
+                    help="Keep running and process new Takeout drops in source_folder as they complete")
+parser.add_argument('--settle', type=float, default=10,
+                    help="With --watch, seconds a file must stay unchanged before it counts as complete (default: 10)")
+parser.add_argument('--stats',
+                    help="With --watch, serve queue depth and throughput as JSON on host:port or unix:/path/to/socket")
 
 args = parser.parse_args()
 
@@ -28,5 +75,15 @@ if not os.path.exists(args.source_folder):
     print('Target folder doesn\'t exist')
     exit()
 
-processFolder(args.source_folder, args.edited_word,
-              args.optimize, args.output_folder, args.max_dimension)
+options = dict(jobs=args.jobs, video_jobs=args.video_jobs,
+               order=args.order, readahead=args.readahead, drop_outputs=args.drop_cache,
+               renditions=args.renditions, max_memory=args.max_memory)
+
+if args.watch:
+    from watch import watchFolder
+    watchFolder(args.source_folder, args.edited_word,
+                args.optimize, args.output_folder, args.max_dimension,
+                settle=args.settle, stats_address=args.stats, **options)
+else:
+    processFolder(args.source_folder, args.edited_word,
+                  args.optimize, args.output_folder, args.max_dimension, **options)
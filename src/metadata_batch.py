@@ -0,0 +1,80 @@
+import json
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+
+PreparedSidecar = namedtuple(
+    'PreparedSidecar', ['path', 'timestamp', 'exif_date', 'utime', 'title', 'description', 'people_tag'])
+
+
+# Bounded, a watch daemon keeps these caches for its whole lifetime
+@lru_cache(maxsize=65536)
+def exif_date(timestamp):
+    """EXIF formatted local date of a unix timestamp, computed once per distinct timestamp"""
+    return datetime.fromtimestamp(timestamp).strftime("%Y:%m:%d %H:%M:%S")
+
+
+@lru_cache(maxsize=4096)
+def join_people(names):
+    return ", ".join(names) if names else ""
+
+
+def people_names(people):
+    names = []
+    for person in people:
+        if isinstance(person, str):
+            names.append(person)
+        elif isinstance(person, dict) and 'name' in person:
+            names.append(person['name'])
+    return tuple(names)
+
+
+class MetadataBatch:
+    """the fields the writers need from a set of sidecars, prepared up front
+    Values are kept column by column and repeated dates and people lists are
+    shared, so per file the writers only do a lookup.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.paths = []
+        self.timestamps = []
+        self.exif_dates = []
+        self.titles = []
+        self.descriptions = []
+        self.people_tags = []
+
+    def add(self, path, metadata):
+        timestamp = int(metadata['photoTakenTime']['timestamp'])
+        self.rows[path] = len(self.paths)
+        self.paths.append(path)
+        self.timestamps.append(timestamp)
+        self.exif_dates.append(exif_date(timestamp))
+        self.titles.append(metadata.get('title', ''))
+        self.descriptions.append(metadata.get('description', ''))
+        self.people_tags.append(join_people(people_names(metadata.get('people', []))))
+
+    def get(self, path):
+        row = self.rows.get(path)
+        if row is None:
+            return None
+        timestamp = self.timestamps[row]
+        return PreparedSidecar(path, timestamp, self.exif_dates[row], (timestamp, timestamp),
+                               self.titles[row], self.descriptions[row], self.people_tags[row])
+
+
+def prepare_metadata(sidecar_paths):
+    """parse every sidecar once and prepare its dates and tags
+    Sidecars that can't be read are left out, get() returns None for them.
+    """
+    batch = MetadataBatch()
+    for path in sidecar_paths:
+        if not path or path in batch.rows:
+            continue
+        try:
+            with open(path, encoding="utf8") as f:
+                batch.add(path, json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Unreadable metadata {path}: {e}")
+    return batch
@@ -1,6 +1,10 @@
 import os
 from auxFunctions import *
-import json
+from exiftool import run_exiftool
+from matching import MediaMatcher, assign_media
+from memory import MemoryBudget, StageMemory, estimate_decode_cost
+from metadata_batch import prepare_metadata
+from scheduler import CacheDropper, is_video, run_scheduled
 import subprocess
 from PIL import Image
 from pillow_heif import register_heif_opener
@@ -18,22 +22,32 @@ piexifCodecs = [k.casefold() for k in ['TIF', 'TIFF', 'JPEG',
                                        'JPG', 'HEIC', 'PNG', 'MP4', 'MOV', 'AVI']]
 
 
-def get_files_from_folder(folder: str, edited_word: str):
-    files: list[tuple[str, str]] = []
+def get_files_from_folder(folder: str, edited_word: str, matcher=None):
+    if matcher is None:
+        matcher = MediaMatcher(edited_words=[edited_word])
+
+    files: list[tuple[str, str, float]] = []
     folder_entries = list(os.scandir(folder))
+    matcher.index.add_folder(
+        folder, [entry.name for entry in folder_entries if entry.is_file()])
 
+    matches = []
     for entry in folder_entries:
         if entry.is_dir():
             print(f"Checking: {entry}")
-            files += get_files_from_folder(entry.path, edited_word)
+            files += get_files_from_folder(entry.path, edited_word, matcher)
             continue
 
         if entry.is_file():
             (file_name, ext) = os.path.splitext(entry.name)
 
             if ext == ".json" and file_name != "metadata":
-                file = searchMedia(folder, file_name, edited_word)
-                files.append((entry.path, file))
+                (file, confidence) = matcher.match_media(entry.path)
+                matches.append((entry.path, file, confidence))
+
+    # A media file matched by several sidecars only goes to the best one,
+    # the others are reported as missing
+    files += assign_media(matches)
 
     return files
 
@@ -46,59 +60,8 @@ def get_output_filename(root_folder, out_folder, image_path):
     return os.path.join(out_folder, relative_to_new_image_folder, new_image_name)
 
 
-def extract_video_metadata(video_path, metadata_path):
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-
-    # Extract relevant metadata fields
-    title = metadata.get('title', '')
-    description = metadata.get('description', '')
-    # creation_time = int(metadata['creationTime']['timestamp'])
-    photo_taken_time = int(metadata['photoTakenTime']['timestamp'])
-    latitude = metadata['geoData']['latitude']
-    longitude = metadata['geoData']['longitude']
-    altitude = metadata['geoData']['altitude']
-    people = [person['name'] for person in metadata.get('people', [])]
-
-    # Construct a dictionary with the extracted metadata
-    video_metadata = {
-        'title': title,
-        'description': description,
-        # 'creation_time': creation_time,
-        'photo_taken_time': photo_taken_time,
-        'latitude': latitude,
-        'longitude': longitude,
-        'altitude': altitude,
-        'people': people
-        # Add more metadata fields as needed
-    }
-    return video_metadata
-
-
-def extract_image_metadata(image_path, metadata_path):
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-
-    # Extract relevant metadata fields
-    title = metadata.get('title', '')
-    description = metadata.get('description', '')
-    people = [person['name']
-              for person in metadata.get('people', [])]  # Extract names only
-
-    # Construct a dictionary with the extracted metadata
-    image_metadata = {
-        'title': title,
-        'description': description,
-        'people': people  # Store only names in 'people'
-        # Add more metadata fields as needed
-    }
-    return image_metadata
-
-
 def save_processed_video(video_path, out_folder, metadata):
-    # Extract photoTakenTime from metadata
     output_path = os.path.join(out_folder, os.path.basename(video_path))
-    people_tag = ", ".join(metadata['people']) if metadata['people'] else ""
 
     # Construct FFmpeg command to copy video and audio streams and add metadata
     ffmpeg_command = [
@@ -106,8 +69,8 @@ def save_processed_video(video_path, out_folder, metadata):
         '-fflags', '+genpts',  # Add this flag to handle non-monotonic DTS
         '-i', video_path,
         '-c', 'copy',
-        '-metadata', f'title={metadata["title"]}',
-        '-metadata', f'description={metadata["description"]}',
+        '-metadata', f'title={metadata.title}',
+        '-metadata', f'description={metadata.description}',
         output_path
     ]
 
@@ -119,34 +82,22 @@ def save_processed_video(video_path, out_folder, metadata):
         exiftool_path,
         '-overwrite_original',
         '-TagsFromFile', video_path,
-        '-XMP:PersonInImage=' + people_tag,
+        '-XMP:PersonInImage=' + metadata.people_tag,
         output_path
     ]
 
     # Execute exiftool command
-    subprocess.run(exiftool_command, check=True)
+    run_exiftool(exiftool_command)
 
-    print("Video saved successfully!")
-    setFileCreationTime(output_path, metadata["photo_taken_time"])
+    os.utime(output_path, metadata.utime)
 
     # Delete original video file and metadata
     os.remove(video_path)
-    os.remove(metadata_path)
+    os.remove(metadata.path)
+    return output_path
 
 
-def save_processed_image(image_path, output_path, metadata):
-    # Extract photoTakenTime from metadata
-    # output_path = os.path.join(out_folder, os.path.basename(image_path))
-
-    # Extract and format people tags
-    people_tags = []
-    for person in metadata['people']:
-        if isinstance(person, str):
-            people_tags.append(person)
-        elif isinstance(person, dict) and 'name' in person:
-            people_tags.append(person['name'])
-
-    people_tag = ", ".join(people_tags) if people_tags else ""
+def save_processed_image(image_path, output_path, people_tag):
 
     # Construct exiftool command to add people tag
     exiftool_command = [
@@ -158,143 +109,228 @@ def save_processed_image(image_path, output_path, metadata):
     ]
 
     # Execute exiftool command
-    subprocess.run(exiftool_command, check=True)
-    print("Image saved successfully!")
+    run_exiftool(exiftool_command)
+
+
+def reduce_image(image, max_dimension):
+    if not max_dimension:
+        return image
+    (width, height) = image.size
+    scale = min(max_dimension[0] / width, max_dimension[1] / height)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+
+def get_renditions(out_folder, optimize, max_dimension, renditions=None):
+    """list the (output folder, max dimension, quality) targets of every image
+    Without renditions there is a single target in out_folder, otherwise each rendition
+    gets its own folder named after it, largest first.
+    """
+    if not renditions:
+        return [(out_folder, max_dimension, optimize)]
+
+    targets = [(os.path.join(out_folder, name), max_dimension, quality)
+               for (name, max_dimension, quality) in renditions]
+    targets.sort(key=lambda target: target[1][0] if target[1] else float('inf'),
+                 reverse=True)
+    return targets
+
+
+def get_prepared_metadata(batch, metadata_path):
+    metadata = batch.get(metadata_path)
+    if metadata is None:
+        raise ValueError(f"Unreadable metadata: {metadata_path}")
+    return metadata
+
+
+def move_to_failures(failures_dir, *paths):
+    for path in paths:
+        failure_path = os.path.join(failures_dir, os.path.basename(path))
+        if os.path.exists(failure_path):
+            os.remove(failure_path)
+        os.rename(path, failure_path)
+
+
+def process_entry(entry, root_folder, out_folder, failures_dir, renditions, stages, batch,
+                  dropper=None):
+    """process a single (metadata_path, file_path, confidence) entry on a worker thread
+    Nothing is printed here, the caller reports the file under its progress bar.
+    return: tuple like (success, error message or None)
+    """
+    (metadata_path, file_path, _) = entry
+
+    if not file_path:
+        # Move the metadata file to failures directory
+        move_to_failures(failures_dir, metadata_path)
+        return (False, f"Missing file for: {metadata_path}")
+
+    (_, ext) = os.path.splitext(file_path)
+
+    if not ext[1:].casefold() in piexifCodecs:
+        # Move the file to failures directory
+        move_to_failures(failures_dir, file_path)
+        return (False, f"File format is not supported: {file_path}")
+
+    if ext[1:].casefold() in ['mp4', 'mov', 'avi']:
+        # Video processing
+        try:
+            metadata = get_prepared_metadata(batch, metadata_path)
+            output_path = save_processed_video(file_path, out_folder, metadata)
+            if dropper:
+                dropper.drop(output_path)
+            stages.record("video")
+            return (True, None)
+        except Exception as e:
+            # Move the file and metadata to failures directory
+            move_to_failures(failures_dir, file_path, metadata_path)
+            return (False, f"Error processing video: {e}")
+
+    elif ext[1:].casefold() in ['tif', 'tiff', 'jpeg', 'jpg', 'heic', 'png']:
+        # Image processing
+        try:
+            source = Image.open(file_path, mode="r")
+            source.load()
+            image = source.convert('RGB')
+            # Sampled while the decoded source and its RGB copy both exist
+            stages.record("decode")
+            source.close()
+            del source
+
+            image_exif = image.getexif()
+            if OrientationTagID in image_exif:
+                orientation = image_exif[OrientationTagID]
+
+                if orientation == 3:
+                    image = image.rotate(180, expand=True)
+                elif orientation == 6:
+                    image = image.rotate(270, expand=True)
+                elif orientation == 8:
+                    image = image.rotate(90, expand=True)
+
+            metadata = get_prepared_metadata(batch, metadata_path)
+
+            new_exif = None
+            if "exif" in image.info:
+                new_exif = adjust_exif(image.info["exif"], metadata.exif_date)
+
+            # Renditions are ordered largest first, so each one is reduced
+            # from the previous rendition instead of the full decode
+            for (rendition_folder, max_dimension, quality) in renditions:
+                image = reduce_image(image, max_dimension)
 
+                new_image_path = get_output_filename(
+                    root_folder, rendition_folder, file_path)
 
-def processFolder(root_folder, edited_word, optimize, out_folder, max_dimension):
-    errorCounter = 0
-    successCounter = 0
+                dir = os.path.dirname(new_image_path)
+                os.makedirs(dir, exist_ok=True)
 
-    files = get_files_from_folder(root_folder, edited_word)
+                if new_exif:
+                    image.save(new_image_path, quality=quality, exif=new_exif)
+                else:
+                    image.save(new_image_path, quality=quality)
 
-    print("Total files found:", len(files))
+                stages.record("encode")
 
-    # Create failures directory if it doesn't exist
-    failures_dir = os.path.join(out_folder, "failures")
-    if not os.path.exists(failures_dir):
-        os.makedirs(failures_dir)
+                save_processed_image(file_path, new_image_path, metadata.people_tag)
+                os.utime(new_image_path, metadata.utime)
+                if dropper:
+                    dropper.drop(new_image_path)
+                stages.record("metadata")
 
-    for entry in progressBar(files, upLines=2):
-        metadata_path = entry[0]
-        file_path = entry[1]
+            os.remove(file_path)
+            os.remove(metadata_path)
 
-        print("\n", "Current file:", file_path, CLR)
+            return (True, None)
+        except Exception as e:
+            # Move the file and metadata to failures directory
+            move_to_failures(failures_dir, file_path, metadata_path)
+            return (False, f"Error processing image: {e}")
 
-        if not file_path:
-            print(CURSOR_UP_FACTORY(2), "Missing file for:",
-                  metadata_path, CLR, CURSOR_DOWN_FACTORY(2))
-            errorCounter += 1
-            # Move the metadata file to failures directory
-            failure_metadata_path = os.path.join(
-                failures_dir, os.path.basename(metadata_path))
-            if os.path.exists(failure_metadata_path):
-                os.remove(failure_metadata_path)
-            os.rename(metadata_path, failure_metadata_path)
-            continue
+    return (False, None)
 
-        (_, ext) = os.path.splitext(file_path)
 
-        if not ext[1:].casefold() in piexifCodecs:
-            print(CURSOR_UP_FACTORY(2), 'File format is not supported:',
-                  file_path, CLR, CURSOR_DOWN_FACTORY(2))
-            errorCounter += 1
-            # Move the file to failures directory
-            failure_file_path = os.path.join(
-                failures_dir, os.path.basename(file_path))
-            if os.path.exists(failure_file_path):
-                os.remove(failure_file_path)
-            os.rename(file_path, failure_file_path)
-            continue
+def processFolder(root_folder, edited_word, optimize, out_folder, max_dimension,
+                  jobs=None, video_jobs=1, order='size', readahead=0, renditions=None,
+                  max_memory=None, drop_outputs=False):
+    stages = StageMemory()
 
-        if ext[1:].casefold() in ['mp4', 'mov', 'avi']:
-            # Video processing
-            try:
-                print("VIDEO IDENTIFIED")
-                metadata = extract_video_metadata(file_path, metadata_path)
-                save_processed_video(file_path, out_folder, metadata)
-                successCounter += 1
-            except Exception as e:
-                print(CURSOR_UP_FACTORY(2), 'Error processing video:',
-                      str(e), CLR, CURSOR_DOWN_FACTORY(2))
-                errorCounter += 1
-                # Move the file and metadata to failures directory
-                failure_file_path = os.path.join(
-                    failures_dir, os.path.basename(file_path))
-                if os.path.exists(failure_file_path):
-                    os.remove(failure_file_path)
-                os.rename(file_path, failure_file_path)
-                failure_metadata_path = os.path.join(
-                    failures_dir, os.path.basename(metadata_path))
-                if os.path.exists(failure_metadata_path):
-                    os.remove(failure_metadata_path)
-                os.rename(metadata_path, failure_metadata_path)
-                continue
-
-        elif ext[1:].casefold() in ['tif', 'tiff', 'jpeg', 'jpg', 'heic', 'png']:
-            # Image processing
-            try:
-                print("IMAGE IDENTIFIED")
-                image = Image.open(file_path, mode="r").convert('RGB')
-
-                image_exif = image.getexif()
-                if OrientationTagID in image_exif:
-                    print("ORIENTATION FOUND")
-                    orientation = image_exif[OrientationTagID]
-
-                    if orientation == 3:
-                        image = image.rotate(180, expand=True)
-                    elif orientation == 6:
-                        image = image.rotate(270, expand=True)
-                    elif orientation == 8:
-                        image = image.rotate(90, expand=True)
-
-                if max_dimension:
-                    image.thumbnail(max_dimension)
+    files = get_files_from_folder(root_folder, edited_word)
+    stages.record("scan")
 
-                new_image_path = get_output_filename(
-                    root_folder, out_folder, file_path)
+    print("Total files found:", len(files))
+
+    processFiles(root_folder, files, optimize, out_folder, max_dimension,
+                 jobs=jobs, video_jobs=video_jobs, order=order, readahead=readahead,
+                 renditions=renditions, max_memory=max_memory, drop_outputs=drop_outputs,
+                 stages=stages)
 
-                dir = os.path.dirname(new_image_path)
 
-                if not os.path.exists(dir):
-                    os.makedirs(dir)
+def processFiles(root_folder, files, optimize, out_folder, max_dimension,
+                 jobs=None, video_jobs=1, order='size', readahead=0, renditions=None,
+                 max_memory=None, drop_outputs=False, stages=None):
+    """process (metadata_path, file_path, confidence) entries found under root_folder
+    return: tuple like (successes, errors)
+    """
+    errorCounter = 0
+    successCounter = 0
+    stages = stages or StageMemory()
 
-                with open(metadata_path, encoding="utf8") as f:
-                    metadata = json.load(f)
+    batch = prepare_metadata([entry[0] for entry in files if entry[1]])
+    stages.record("prepare")
 
-                timeStamp = int(metadata['photoTakenTime']['timestamp'])
-                if "exif" in image.info:
-                    new_exif = adjust_exif(image.info["exif"], metadata)
-                    image.save(new_image_path, quality=optimize, exif=new_exif)
-                else:
-                    image.save(new_image_path, quality=optimize)
-
-                metadata = extract_image_metadata(file_path, metadata_path)
-                save_processed_image(file_path, new_image_path, metadata)
-                setFileCreationTime(new_image_path, timeStamp)
-
-                os.remove(file_path)
-                os.remove(metadata_path)
-
-                successCounter += 1
-            except Exception as e:
-                print(CURSOR_UP_FACTORY(2), 'Error processing image:',
-                      str(e), CLR, CURSOR_DOWN_FACTORY(2))
-                errorCounter += 1
-                # Move the file and metadata to failures directory
-                failure_file_path = os.path.join(
-                    failures_dir, os.path.basename(file_path))
-                if os.path.exists(failure_file_path):
-                    os.remove(failure_file_path)
-                os.rename(file_path, failure_file_path)
-                failure_metadata_path = os.path.join(
-                    failures_dir, os.path.basename(metadata_path))
-                if os.path.exists(failure_metadata_path):
-                    os.remove(failure_metadata_path)
-                os.rename(metadata_path, failure_metadata_path)
-                continue
+    # Create failures directory if it doesn't exist
+    failures_dir = os.path.join(out_folder, "failures")
+    if not os.path.exists(failures_dir):
+        os.makedirs(failures_dir)
+
+    targets = get_renditions(out_folder, optimize, max_dimension, renditions)
+    jobs = jobs or os.cpu_count() or 1
+
+    # Estimated from the image headers, so the budget knows the decode cost
+    # before anything is decoded
+    budget = MemoryBudget(max_memory) if max_memory else None
+    costs = {}
+    if budget:
+        costs = {entry[1]: estimate_decode_cost(entry[1]) for entry in files
+                 if entry[1] and not is_video(entry[1])}
+
+    dropper = CacheDropper() if drop_outputs else None
+
+    def large_job(entry):
+        # An image that would blow the budget if every worker had one
+        return costs.get(entry[1], 0) * jobs > max_memory
+
+    def worker(entry):
+        if not budget:
+            return process_entry(entry, root_folder, out_folder, failures_dir,
+                                 targets, stages, batch, dropper)
+        with budget.admit(costs.get(entry[1], 0)):
+            return process_entry(entry, root_folder, out_folder, failures_dir,
+                                 targets, stages, batch, dropper)
+
+    results = run_scheduled(files, worker, media_path=lambda entry: entry[1],
+                            photo_workers=jobs, video_workers=video_jobs,
+                            order=order, readahead=readahead,
+                            large_job=large_job if budget else None,
+                            failed=(False, None))
+
+    # Workers run concurrently, so only this loop writes under the progress bar
+    for (entry, (success, error)) in progressBar(results, upLines=2, total=len(files)):
+        print("\n", "Current file:", entry[1] or entry[0],
+              f"(match confidence {entry[2]:.1f})", CLR)
+        if error:
+            print(CURSOR_UP_FACTORY(2), error, CLR, CURSOR_DOWN_FACTORY(2))
+        if success:
+            successCounter += 1
+        else:
+            errorCounter += 1
+    if dropper:
+        dropper.close()
 
     print("\nProcessing complete!")
     print(f"Successes: {successCounter}")
     print(f"Errors: {errorCounter}")
+    stages.report()
+    return (successCounter, errorCounter)
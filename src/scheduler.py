@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+VIDEO_EXTENSIONS = ['mp4', 'mov', 'avi']
+ORDERS = ['size', 'locality']
+
+# Outputs written since a file was first advised, before it is advised again
+DROP_DEPTH = 64
+
+
+def is_video(path):
+    if not path:
+        return False
+    (_, ext) = os.path.splitext(path)
+    return ext[1:].casefold() in VIDEO_EXTENSIONS
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except (OSError, TypeError):
+        return 0
+
+
+def size_key(path):
+    # Starting the biggest jobs first keeps the run from ending on a long tail
+    return -file_size(path)
+
+
+def locality_key(path):
+    # Same directory, then inode order: close to the on-disk layout on
+    # HDD and NAS sources, so reads stop seeking back and forth
+    if not path:
+        return ('', 0)
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        inode = 0
+    return (os.path.dirname(path), inode)
+
+
+def order_jobs(jobs, media_path, order='size'):
+    """split the jobs into a photo and a video lane, each sorted by the given order
+    Keyword arguments: jobs is a list of work items, media_path maps an item to its media file,
+    order is 'size' (largest first) or 'locality' (directory and inode order)
+    return: tuple like (photo_jobs, video_jobs)
+    """
+    key = locality_key if order == 'locality' else size_key
+    photos = []
+    videos = []
+    for job in jobs:
+        path = media_path(job)
+        lane = videos if is_video(path) else photos
+        lane.append((key(path), job))
+
+    photos.sort(key=lambda item: item[0])
+    videos.sort(key=lambda item: item[0])
+    return [job for (_, job) in photos], [job for (_, job) in videos]
+
+
+def fadvise(path, advice):
+    if not path or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def dontneed(fd):
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+class CacheDropper:
+    """drop finished outputs from the page cache without waiting for them to reach the disk
+    DONTNEED starts the writeback of dirty pages but only evicts the clean ones, so
+    each file is advised once when it is done and again after depth newer files,
+    when its writeback is normally over. The descriptor stays open in between,
+    so the file can be renamed meanwhile.
+    """
+
+    def __init__(self, depth=DROP_DEPTH):
+        self.depth = depth
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def drop(self, path):
+        if not path or not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        dontneed(fd)
+        with self.lock:
+            self.pending.append(fd)
+            expired = [self.pending.popleft()
+                       for _ in range(len(self.pending) - self.depth)]
+        for fd in expired:
+            dontneed(fd)
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            expired = list(self.pending)
+            self.pending.clear()
+        for fd in expired:
+            dontneed(fd)
+            os.close(fd)
+
+
+class ReadAhead:
+    """issue WILLNEED hints for the next files of a lane
+    Only does something where os.posix_fadvise is available (Linux, most Unixes).
+    """
+
+    def __init__(self, paths, depth):
+        self.paths = paths
+        self.depth = depth
+        self.issued = 0
+        self.lock = threading.Lock()
+
+    def started(self, index):
+        if self.depth <= 0:
+            return
+        with self.lock:
+            end = min(index + 1 + self.depth, len(self.paths))
+            pending = self.paths[self.issued:end]
+            self.issued = max(self.issued, end)
+        for path in pending:
+            fadvise(path, os.POSIX_FADV_WILLNEED)
+
+    def run(self, index, worker, job):
+        self.started(index)
+        return worker(job)
+
+
+def run_scheduled(jobs, worker, media_path, photo_workers=None, video_workers=1,
+                  order='size', readahead=0, large_job=None, large_workers=1, failed=False):
+    """run worker(job) for every job, videos in their own small lane
+    Videos are I/O bound remuxes, so they get a separate budget and never
+    block the photo lane, which is sized to the CPU count. Photos for which
+    large_job(job) is true get a low-concurrency lane of their own.
+    With readahead > 0 the next files of each lane are prefetched while the
+    current ones are being processed.
+    Yields (job, result) pairs in completion order; a job whose worker raised
+    yields the failed value instead, so one error doesn't end the run.
+    """
+    photo_workers = photo_workers or os.cpu_count() or 1
+    video_workers = max(1, video_workers)
+    large_workers = max(1, large_workers)
+    (photos, videos) = order_jobs(jobs, media_path, order)
+    large = []
+    if large_job:
+        large = [job for job in photos if large_job(job)]
+        photos = [job for job in photos if not large_job(job)]
+
+    with ThreadPoolExecutor(max_workers=photo_workers) as photo_pool, \
+            ThreadPoolExecutor(max_workers=video_workers) as video_pool, \
+            ThreadPoolExecutor(max_workers=large_workers) as large_pool:
+        futures = {}
+        # Videos are submitted first so the long remuxes start right away
+        for (pool, lane) in [(video_pool, videos), (large_pool, large), (photo_pool, photos)]:
+            prefetch = ReadAhead([media_path(job) for job in lane], readahead)
+            for (index, job) in enumerate(lane):
+                futures[pool.submit(prefetch.run, index, worker, job)] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Failed to process {media_path(job)}: {e}")
+                result = failed
+            yield job, result
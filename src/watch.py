@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+import exiftool
+from matching import MediaMatcher, assign_media
+from process_folder import processFiles, exiftool_path
+
+
+# inotify(7) event flags
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+POLL_INTERVAL = 10
+
+# A sidecar whose media never shows up is processed as missing after this long
+ORPHAN_AFTER = 3600
+
+# Pairs handed to processFiles at once, per photo worker: enough to keep the
+# workers busy, small enough for the stats to move and for shutdown to be quick
+BATCH_PER_JOB = 4
+
+
+def list_folders(root):
+    folders = []
+    pending = [root]
+    while pending:
+        folder = pending.pop()
+        folders.append(folder)
+        try:
+            with os.scandir(folder) as entries:
+                pending += [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            pass
+    return folders
+
+
+class InotifyWatcher:
+    """report changed folders through inotify, watching every folder under root"""
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.folders = {}
+        for folder in list_folders(root):
+            self.watch(folder)
+
+    def watch(self, folder):
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if descriptor >= 0:
+            self.folders[descriptor] = folder
+
+    def wait(self, timeout):
+        """return: set of the folders that changed within timeout seconds"""
+        changed = set()
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            (descriptor, mask, _, length) = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.folders.values())
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(descriptor, None)
+                continue
+            folder = self.folders.get(descriptor)
+            if folder is None:
+                continue
+            changed.add(folder)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # A new folder can already have content by the time it is watched
+                for new_folder in list_folders(os.path.join(folder, os.fsdecode(name))):
+                    self.watch(new_folder)
+                    changed.add(new_folder)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """fallback where inotify isn't available: the whole tree is rescanned every interval seconds"""
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.last_poll = time.time()
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        if time.time() - self.last_poll < self.interval:
+            return set()
+        self.last_poll = time.time()
+        return set(list_folders(self.root))
+
+    def close(self):
+        pass
+
+
+def create_watcher(root):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError, TypeError):
+        print("inotify is not available, polling the inbox instead")
+        return PollingWatcher(root)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queued = 0
+        self.in_progress = 0
+        self.successes = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+    def add_queued(self, count):
+        with self.lock:
+            self.queued += count
+
+    def start(self, count):
+        with self.lock:
+            self.queued -= count
+            self.in_progress += count
+
+    def finish(self, count, successes, errors, seconds):
+        with self.lock:
+            self.in_progress -= count
+            self.successes += successes
+            self.errors += errors
+            self.busy_seconds += seconds
+
+    def snapshot(self):
+        with self.lock:
+            processed = self.successes + self.errors
+            return {
+                'queue_depth': self.queued,
+                'in_progress': self.in_progress,
+                'successes': self.successes,
+                'errors': self.errors,
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'files_per_second': round(processed / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            }
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_stats(address, stats):
+    """serve the stats as JSON on 'host:port' or on a Unix socket given as 'unix:/path'"""
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(stats.snapshot()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixHTTPServer(path, StatsHandler)
+    else:
+        (host, port) = address.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), StatsHandler)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving stats on {address}")
+    return server
+
+
+class InboxDaemon:
+    """hand completed sidecar/media pairs of an inbox folder to processFiles as they arrive"""
+
+    def __init__(self, inbox, edited_word, settle, process, batch_size):
+        self.inbox = os.path.normpath(inbox)
+        self.settle = settle
+        self.process = process
+        self.batch_size = batch_size
+        self.matcher = MediaMatcher(edited_words=[edited_word])
+        # path -> (size, mtime_ns, unchanged since)
+        self.files = {}
+        self.folder_files = {}
+        self.submitted = set()
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.stop = threading.Event()
+        self.processor = None
+
+    def scan(self, folder):
+        try:
+            entries = [entry for entry in os.scandir(folder) if entry.is_file()]
+        except OSError:
+            entries = []
+
+        now = time.time()
+        current = set()
+        names = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            names.append(entry.name)
+            current.add(entry.path)
+            state = (stat.st_size, stat.st_mtime_ns)
+            known = self.files.get(entry.path)
+            if known is None or known[:2] != state:
+                self.files[entry.path] = state + (now,)
+
+        for path in self.folder_files.get(folder, set()) - current:
+            self.files.pop(path, None)
+            self.submitted.discard(path)
+        self.folder_files[folder] = current
+        self.matcher.index.replace_folder(folder, names)
+
+    def settled(self, path, now):
+        # Files still being copied keep changing size or mtime
+        known = self.files.get(path)
+        return known is not None and now - known[2] >= self.settle
+
+    def collect(self, folders):
+        """queue the completed pairs of the given folders
+        return: set of the folders which still have sidecars waiting to settle or for their media
+        """
+        now = time.time()
+        waiting = set()
+        pairs = []
+        for folder in folders:
+            matches = []
+            for path in self.folder_files.get(folder, ()):
+                (name, ext) = os.path.splitext(os.path.basename(path))
+                if ext != ".json" or name == "metadata" or path in self.submitted:
+                    continue
+                (media, confidence) = self.matcher.match_media(path)
+                matches.append((path, media, confidence))
+
+            for ((path, media, confidence), (_, assigned, _)) in zip(matches, assign_media(matches)):
+                if not self.settled(path, now):
+                    waiting.add(folder)
+                    continue
+
+                if media is not None and (assigned is None or media in self.submitted):
+                    # Another sidecar matched this media better, or already took it
+                    (media, confidence) = (None, 0.0)
+                elif media is None and now - self.files[path][2] < ORPHAN_AFTER:
+                    waiting.add(folder)
+                    continue
+                elif media is not None and not self.settled(media, now):
+                    waiting.add(folder)
+                    continue
+
+                pairs.append((path, media, confidence))
+                self.submitted.add(path)
+                if media:
+                    self.submitted.add(media)
+
+        if pairs:
+            self.stats.add_queued(len(pairs))
+            for pair in pairs:
+                self.queue.put(pair)
+        return waiting
+
+    def process_queue(self):
+        while not self.stop.is_set():
+            try:
+                pairs = [self.queue.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            while len(pairs) < self.batch_size:
+                try:
+                    pairs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.stats.start(len(pairs))
+            started = time.time()
+            try:
+                (successes, errors) = self.process(pairs)
+            except Exception as e:
+                print(f"Error processing {len(pairs)} file(s): {e}")
+                (successes, errors) = (0, len(pairs))
+            self.stats.finish(len(pairs), successes, errors, time.time() - started)
+
+    def run(self, watcher):
+        self.processor = threading.Thread(target=self.process_queue)
+        self.processor.start()
+
+        waiting = set(list_folders(self.inbox))
+        for folder in waiting:
+            self.scan(folder)
+        tick = min(self.settle, 1.0) or 1.0
+        while not self.stop.is_set():
+            changed = watcher.wait(tick)
+            # Folders with unsettled files are rescanned every tick, so the
+            # debounce also ends when no more events come in
+            for folder in changed | waiting:
+                self.scan(folder)
+            waiting = self.collect(changed | waiting)
+
+    def shutdown(self):
+        """stop queuing and wait for the batch in progress
+        Pairs still in the queue are left in the inbox and picked up by the next run.
+        """
+        self.stop.set()
+        if self.processor:
+            self.processor.join()
+
+
+def watchFolder(inbox, edited_word, optimize, out_folder, max_dimension, settle=10,
+                stats_address=None, **options):
+    """process the Takeout drops of the inbox folder as they complete, until interrupted"""
+    # Load every Pillow plugin and start exiftool once for the whole run
+    Image.init()
+    exiftool.start_workers(exiftool_path)
+
+    def process(pairs):
+        return processFiles(inbox, pairs, optimize, out_folder, max_dimension, **options)
+
+    batch_size = BATCH_PER_JOB * (options.get('jobs') or os.cpu_count() or 1)
+    daemon = InboxDaemon(inbox, edited_word, settle, process, batch_size)
+    watcher = create_watcher(daemon.inbox)
+    server = serve_stats(stats_address, daemon.stats) if stats_address else None
+
+    print(f"Watching {inbox}")
+    try:
+        daemon.run(watcher)
+    except KeyboardInterrupt:
+        print("\nStopping")
+    finally:
+        daemon.shutdown()
+        watcher.close()
+        if server:
+            server.shutdown()
+        exiftool.stop_workers()
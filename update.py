@@ -1,12 +1,16 @@
 import os
-import re
 import json
 import subprocess
 import argparse
 from datetime import datetime
 from tqdm import tqdm
 import shutil
-import time
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from matching import MediaMatcher  # noqa: E402
+from metadata_batch import prepare_metadata  # noqa: E402
+from scheduler import ORDERS, CacheDropper, run_scheduled  # noqa: E402
 
 allowed_extensions = [
     'jpg', 'jpeg', 'png', 'tif', 'gif', 'jfif', 'mp4', 'mov', 'heic', 'webp',
@@ -14,17 +18,21 @@ allowed_extensions = [
 ]
 
 
-def get_files_in_directory(directory, extensions):
+def get_files_in_directory(directory, extensions, matcher):
     valid_files = []
     failure_files = []
 
-    for root, _, filenames in os.walk(directory):
+    for root, dirnames, filenames in os.walk(directory):
+        # Skip failures & successes
+        dirnames[:] = [name for name in dirnames
+                       if name not in ('failures', 'successes')]
+        if os.path.basename(root) in ('failures', 'successes'):
+            continue
+
+        matcher.index.add_folder(root, filenames)
         for filename in filenames:
             file_path = os.path.join(root, filename)
 
-            if 'failures' in file_path.split(os.sep) or 'successes' in file_path.split(os.sep):
-                continue  # Skip failures & successes
-
             ext = filename.rsplit('.', 1)[-1].lower()
             if ext in extensions:
                 valid_files.append(file_path)
@@ -36,61 +44,36 @@ def get_files_in_directory(directory, extensions):
     return valid_files, failure_files
 
 
-def get_metadata_json(file_path, input_dir):
-
-    json_path = f'{file_path}.json'
+def get_metadata(file_path, sidecars, batch):
+    (json_path, confidence) = sidecars.get(file_path, (None, 0.0))
+    metadata = batch.get(json_path)
 
-    if not os.path.exists(json_path):
-        print(f'{json_path} does not exist.')
-        print('Trying to use metadata from a related media file...')
-        json_path = find_alt_metadata(file_path, input_dir)
-        print(f"NEW JSON PATH: {json_path}")
-
-    if json_path and os.path.exists(json_path):
-        with open(json_path, 'r') as json_file:
-            return json.load(json_file)
+    if metadata:
+        print(f"Metadata: {json_path} (match confidence {confidence:.1f})")
     else:
         print(f"Metadata not found for: {file_path}")
-        return None
-
-
-def get_people_tag(metadata):
-    people_tags = []
-    if 'people' in metadata:
-        for person in metadata['people']:
-            if isinstance(person, str):
-                people_tags.append(person)
-            elif isinstance(person, dict) and 'name' in person:
-                people_tags.append(person['name'])
-    return ", ".join(people_tags) if people_tags else ""
-
-
-def format_datetime(timestamp):
-    return datetime.fromtimestamp(int(timestamp)).strftime('%Y:%m:%d %H:%M:%S')
+    return metadata
 
 
 def set_file_creation_time(filepath, timestamp):
-    date = datetime.fromtimestamp(timestamp)
-    mod_time = time.mktime(date.timetuple())
-    os.utime(filepath, (mod_time, mod_time))
+    os.utime(filepath, (timestamp, timestamp))
 
 
-def update_image_metadata(image_path, metadata, exiftool_path, input_dir):
+def update_image_metadata(image_path, metadata, exiftool_path, input_dir, dropper=None):
     def run_exiftool_command(image_path):
         exiftool_command = [
             exiftool_path,
             '-overwrite_original',
-            f'-XMP:PersonInImage={people_tag}',
-            f'-XMP:Description={metadata.get("description", "")}',
-            f'-EXIF:DateTimeOriginal={formatted_date}',
+            f'-XMP:PersonInImage={metadata.people_tag}',
+            f'-XMP:Description={metadata.description}',
+            f'-EXIF:DateTimeOriginal={metadata.exif_date}',
             image_path
         ]
         subprocess.run(exiftool_command, check=True)
-        set_file_creation_time(image_path, int(
-            metadata['photoTakenTime']['timestamp']))
-
-    people_tag = get_people_tag(metadata)
-    formatted_date = format_datetime(metadata['photoTakenTime']['timestamp'])
+        os.utime(image_path, metadata.utime)
+        # exiftool wrote a new file in place of the original
+        if dropper:
+            dropper.drop(image_path)
 
     try:
         run_exiftool_command(image_path)
@@ -103,8 +86,7 @@ def update_image_metadata(image_path, metadata, exiftool_path, input_dir):
             print(f"Retrying as JPEG: {jpeg_image_path}")
             try:
                 run_exiftool_command(jpeg_image_path)
-                set_file_creation_time(jpeg_image_path, int(
-                    metadata['photoTakenTime']['timestamp']))
+                os.utime(jpeg_image_path, metadata.utime)
                 print(f"Image updated successfully: {jpeg_image_path}")
                 os.remove(image_path)
                 move_to_successes(jpeg_image_path, input_dir)
@@ -117,8 +99,7 @@ def update_image_metadata(image_path, metadata, exiftool_path, input_dir):
             print(f"Retrying as PNG: {png_image_path}")
             try:
                 run_exiftool_command(png_image_path)
-                set_file_creation_time(png_image_path, int(
-                    metadata['photoTakenTime']['timestamp']))
+                os.utime(png_image_path, metadata.utime)
                 print(f"Image updated successfully: {png_image_path}")
                 os.remove(image_path)
                 move_to_successes(png_image_path, input_dir)
@@ -132,22 +113,21 @@ def update_image_metadata(image_path, metadata, exiftool_path, input_dir):
             move_to_failures(image_path, input_dir)
 
 
-def update_video_metadata(video_path, metadata, exiftool_path, input_dir):
-    people_tag = get_people_tag(metadata)
-    formatted_date = format_datetime(metadata['photoTakenTime']['timestamp'])
+def update_video_metadata(video_path, metadata, exiftool_path, input_dir, dropper=None):
     exiftool_command = [
         exiftool_path,
         '-overwrite_original',
-        f'-XMP:PersonInImage={people_tag}',
-        f'-XMP:Description={metadata.get("description", "")}',
-        f'-QuickTime:CreateDate={formatted_date}',
-        f'-QuickTime:ModifyDate={formatted_date}',
+        f'-XMP:PersonInImage={metadata.people_tag}',
+        f'-XMP:Description={metadata.description}',
+        f'-QuickTime:CreateDate={metadata.exif_date}',
+        f'-QuickTime:ModifyDate={metadata.exif_date}',
         video_path
     ]
 
     subprocess.run(exiftool_command, check=True)
-    set_file_creation_time(video_path, int(
-        metadata['photoTakenTime']['timestamp']))
+    os.utime(video_path, metadata.utime)
+    if dropper:
+        dropper.drop(video_path)
 
     move_to_successes(video_path, input_dir)
     print(f"Video updated successfully: {video_path}\n")
@@ -203,94 +183,62 @@ def get_exif_datetime(file_path, exiftool_path):
     return None
 
 
-def find_alt_metadata(file_path, input_dir):
-    file_name = os.path.basename(file_path)
-    base_name, extension = os.path.splitext(file_name)
-
-    # Check if the file name has a number in parentheses
-    match = re.match(r'(.+)\((\d+)\)$', base_name)
-    if match:
-        base_without_number = match.group(1)
-        number = match.group(2)
-        json_names_to_search = [
-            f"{base_without_number}{extension}({number}).json",
-            f"{base_without_number}.JPG({number}).json",
-            f"{base_without_number}.jpg({number}).json",
-            f"{base_without_number}.JPEG({number}).json",
-            f"{base_without_number}.jpeg({number}).json",
-        ]
-    else:
-        base_without_edited = re.sub(
-            r'-edited$', '', base_name, flags=re.IGNORECASE)
-        json_names_to_search = [
-            f"{base_without_edited}{extension}.json",
-            f"{base_name}.JPG.json",
-            f"{base_name}.jpg.json",
-            f"{base_name}.JPEG.json",
-            f"{base_name}.jpeg.json",
-            f"{base_without_edited}.JPG.json",
-            f"{base_without_edited}.jpg.json",
-            f"{base_without_edited}.JPEG.json",
-            f"{base_without_edited}.jpeg.json",
-        ]
-
-    print(f"Searching for JSON files: {json_names_to_search}")
-
-    for root, _, filenames in os.walk(input_dir):
-        for filename in filenames:
-            if filename.lower().endswith('.json'):
-                for json_name in json_names_to_search:
-                    if filename.lower() == json_name.lower():
-                        full_path = os.path.join(root, filename)
-                        print(f"Found matching JSON: {full_path}")
-                        return full_path
-
-                # If no exact match, check if base name is in the JSON filename
-                if base_name.lower() in filename.lower():
-                    full_path = os.path.join(root, filename)
-                    print(f"Found related JSON: {full_path}")
-                    return full_path
-
-    print("No matching or related JSON found")
-    return None
+def process_media_file(media_file, input_dir, exiftool_path, sidecars, batch, dropper=None):
+    try:
+        print(f'\nProcessing: {media_file}')
+        metadata = get_metadata(media_file, sidecars, batch)
+
+        if metadata:
+            if media_file.lower().endswith(('jpg', 'jpeg', 'png', 'tif', 'gif', 'jfif', 'webp', 'heic')):
+                update_image_metadata(
+                    media_file, metadata, exiftool_path, input_dir, dropper)
+            elif media_file.lower().endswith(('mp4', 'mov', 'avi')):
+                update_video_metadata(
+                    media_file, metadata, exiftool_path, input_dir, dropper)
+        else:
+            print(f'No metadata file available for: {media_file}')
+            exif_datetime = get_exif_datetime(media_file, exiftool_path)
+            if exif_datetime:
+                set_file_creation_time(media_file, int(exif_datetime))
+                print(
+                    f"Updated file date/time but that's it: {media_file}")
+                move_to_failures(media_file, input_dir)
+            else:
+                print(f"No EXIF Create Date found for: {media_file}")
+                move_to_failures(media_file, input_dir)
+    except Exception as e:
+        print(f"Failed to process {media_file}: {e}")
+        if os.path.exists(media_file):
+            move_to_failures(media_file, input_dir)
+        else:
+            print(f"{media_file} does not exist. \n")
 
 
-def process_files(input_dir, exiftool_path):
+def process_files(input_dir, exiftool_path, jobs=None, video_jobs=1,
+                  order='size', readahead=0, drop_outputs=False):
+    matcher = MediaMatcher()
     media_files, failures = get_files_in_directory(
-        input_dir, allowed_extensions)
+        input_dir, allowed_extensions, matcher)
     for failure in failures:
         print(f"Moving {failure} to failure directory")
         move_to_failures(failure, input_dir)
 
-    for media_file in tqdm(media_files):
-        try:
-            print(f'\nProcessing: {media_file}')
-            metadata = get_metadata_json(media_file, input_dir)
-
-            if metadata:
-                if media_file.lower().endswith(('jpg', 'jpeg', 'png', 'tif', 'gif', 'jfif', 'webp', 'heic')):
-                    update_image_metadata(
-                        media_file, metadata, exiftool_path, input_dir)
-                elif media_file.lower().endswith(('mp4', 'mov', 'avi')):
-                    update_video_metadata(
-                        media_file, metadata, exiftool_path, input_dir)
-            else:
-                print(f'No metadata file available for: {media_file}')
-                exif_datetime = get_exif_datetime(media_file, exiftool_path)
-                if exif_datetime:
-                    set_file_creation_time(media_file, int(exif_datetime))
-                    print(
-                        f"Updated file date/time but that's it: {media_file}")
-                    move_to_failures(media_file, input_dir)
-                else:
-                    print(f"No EXIF Create Date found for: {media_file}")
-                    move_to_failures(media_file, input_dir)
-        except Exception as e:
-            print(f"Failed to process {media_file}: {e}")
-            if os.path.exists(media_file):
-                move_to_failures(media_file, input_dir)
-            else:
-                print(f"{media_file} does not exist. \n")
+    sidecars = {media_file: matcher.match_sidecar(media_file)
+                for media_file in media_files}
+    batch = prepare_metadata(json_path for (json_path, _) in sidecars.values())
+
+    dropper = CacheDropper() if drop_outputs else None
+
+    def worker(media_file):
+        process_media_file(media_file, input_dir, exiftool_path, sidecars, batch, dropper)
+
+    results = run_scheduled(media_files, worker, media_path=lambda path: path,
+                            photo_workers=jobs, video_workers=video_jobs,
+                            order=order, readahead=readahead)
+    for _ in tqdm(results, total=len(media_files)):
+        pass
+    if dropper:
+        dropper.close()
 
 
 if __name__ == "__main__":
@@ -300,6 +248,19 @@ if __name__ == "__main__":
         'input_directory', help='The input directory containing media files and metadata.')
     parser.add_argument('--exiftool_path', default='exiftool',
                         help='Path to the exiftool executable.')
+    parser.add_argument('--jobs', type=int,
+                        help='Number of images processed in parallel (default: CPU count).')
+    parser.add_argument('--video_jobs', type=int, default=1,
+                        help='Number of videos processed in parallel (default: 1).')
+    parser.add_argument('--order', choices=ORDERS, default='size',
+                        help='Processing order: largest files first, or directory/inode order for HDD and network shares.')
+    parser.add_argument('--readahead', type=int, default=8,
+                        help='Number of upcoming files to prefetch while processing, 0 disables it.')
+    parser.add_argument('--drop_cache', action='store_true',
+                        help='Drop rewritten files from the page cache once they reach the disk.')
 
     args = parser.parse_args()
-    process_files(args.input_directory, args.exiftool_path)
+    process_files(args.input_directory, args.exiftool_path,
+                  jobs=args.jobs, video_jobs=args.video_jobs,
+                  order=args.order, readahead=args.readahead,
+                  drop_outputs=args.drop_cache)